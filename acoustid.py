@@ -19,7 +19,6 @@ from typing import List
 import os
 import json
 import requests
-import contextlib
 import errno
 
 try:
@@ -34,20 +33,35 @@ try:
     have_chromaprint = True
 except ImportError:
     have_chromaprint = False
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+import concurrent.futures
+import functools
+import hashlib
+import sqlite3
 import subprocess
 import threading
 import time
-import gzip
-from io import BytesIO
+import zlib
+
+from urllib.parse import quote_plus, urlencode
 
 API_BASE_URL = 'http://api.acoustid.org/v2/'
 DEFAULT_META = ['recordings']
 REQUEST_INTERVAL = 0.33  # 3 requests/second.
 MAX_AUDIO_LENGTH = 120  # Seconds.
+READ_BUFFER_SIZE = 128 * 1024  # Bytes of PCM per call into Chromaprint.
+COMPRESS_LEVEL = 1  # gzip level for request bodies (1-9).
+COMPRESS_THRESHOLD = 1400  # Smaller request bodies are sent uncompressed.
 FPCALC_COMMAND = 'fpcalc'
 FPCALC_ENVVAR = 'FPCALC'
 MAX_BIT_ERROR = 2  # comparison settings
 MAX_ALIGN_OFFSET = 120
+CACHE_TTL = 30 * 24 * 60 * 60  # Seconds (30 days).
 
 
 # Exceptions.
@@ -104,46 +118,39 @@ def set_base_url(url):
     """Set the URL of the API server to query."""
     if not url.endswith('/'):
         url += '/'
-    global API_BASE_URL
+    global API_BASE_URL, _LOOKUP_URL, _SUBMIT_URL, _SUBMISSION_STATUS_URL
     API_BASE_URL = url
+    # Endpoint URLs are composed once here rather than on every request.
+    _LOOKUP_URL = url + 'lookup'
+    _SUBMIT_URL = url + 'submit'
+    _SUBMISSION_STATUS_URL = url + 'submission_status'
 
 
-def _get_lookup_url():
-    """Get the URL of the lookup API endpoint."""
-    return API_BASE_URL + 'lookup'
-
-
-def _get_submit_url():
-    """Get the URL of the submission API endpoint."""
-    return API_BASE_URL + 'submit'
-
-
-def _get_submission_status_url():
-    """Get the URL of the submission status API endpoint."""
-    return API_BASE_URL + 'submission_status'
+set_base_url(API_BASE_URL)
 
 
 # Compressed HTTP request bodies.
 
 def _compress(data):
     """Compress a bytestring to a gzip archive."""
-    sio = BytesIO()
-    with contextlib.closing(gzip.GzipFile(fileobj=sio, mode='wb')) as f:
-        f.write(data)
-    return sio.getvalue()
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
 
 
-class CompressedHTTPAdapter(requests.adapters.HTTPAdapter):
-    """An `HTTPAdapter` that compresses request bodies with gzip. The
-    Content-Encoding header is set accordingly.
-    """
+# A single session shared by all API requests so that connections to
+# the server are pooled and kept alive between calls.
+_SESSION = requests.Session()
 
-    def add_headers(self, request, **kwargs):
-        body = request.body
-        if not isinstance(body, bytes):
-            body = body.encode('utf8')
-        request.prepare_body(_compress(body), None)
-        request.headers['Content-Encoding'] = 'gzip'
+# Request headers for plain and compressed form bodies. requests already
+# asks for (and transparently decodes) compressed responses.
+_FORM_HEADERS = {
+    'Content-Type': 'application/x-www-form-urlencoded',
+}
+_COMPRESSED_FORM_HEADERS = {
+    'Content-Type': 'application/x-www-form-urlencoded',
+    'Content-Encoding': 'gzip',
+}
 
 
 # Utilities.
@@ -152,8 +159,10 @@ class _rate_limit(object):  # noqa: N801
     """A decorator that limits the rate at which the function may be
     called.  The rate is controlled by the REQUEST_INTERVAL module-level
     constant; set the value to zero to disable rate limiting. The
-    limiting is thread-safe; only one thread may be in the function at a
-    time (acts like a monitor in this sense).
+    limiting is thread-safe: each call reserves the next free time slot
+    while holding a lock, then waits for that slot without the lock so
+    that concurrent callers queue up behind one another instead of
+    behind a sleeping thread.
     """
     def __init__(self, fun):
         self.fun = fun
@@ -161,94 +170,293 @@ class _rate_limit(object):  # noqa: N801
         self.lock = threading.Lock()
 
     def __call__(self, *args, **kwargs):
-        with self.lock:
-            # Wait until request_rate time has passed since last_call,
-            # then update last_call.
-            since_last_call = time.time() - self.last_call
-            if since_last_call < REQUEST_INTERVAL:
-                time.sleep(REQUEST_INTERVAL - since_last_call)
-            self.last_call = time.time()
-
-            # Call the original function.
+        if REQUEST_INTERVAL <= 0:
+            # Rate limiting is disabled; skip the lock entirely.
             return self.fun(*args, **kwargs)
 
+        with self.lock:
+            # Claim the earliest slot at least REQUEST_INTERVAL after
+            # the previously claimed one.
+            now = time.monotonic()
+            slot = max(now, self.last_call + REQUEST_INTERVAL)
+            self.last_call = slot
+
+        # Wait for our slot, then call the original function.
+        if slot > now:
+            time.sleep(slot - now)
+        return self.fun(*args, **kwargs)
+
+
+_thread_state = threading.local()
+
+
+def _get_fingerprinter():
+    """Get a Chromaprint fingerprinter for the current thread, creating
+    it on first use. Calling ``start`` resets its state, so one object
+    can be reused for every fingerprint computed on that thread. It is
+    never shared between threads (or processes).
+    """
+    fper = getattr(_thread_state, 'fingerprinter', None)
+    if fper is None:
+        fper = _thread_state.fingerprinter = chromaprint.Fingerprinter()
+    return fper
+
 
 @_rate_limit
 def _api_request(url, params, timeout=None):
-    """Makes a POST request for the URL with the given form parameters,
-    which are encoded as compressed form data, and returns a parsed JSON
-    response. May raise a WebServiceError if the request fails.
-    If the specified timeout passes, then raises a TimeoutError.
+    """Makes a POST request for the URL with the given form parameters
+    (a dict, a sequence of key/value pairs, or an already-encoded
+    bytestring), which are sent as form data (compressed unless the body
+    is very small), and returns a parsed JSON response. May raise a
+    WebServiceError if the request fails. If the specified timeout
+    passes, then raises a TimeoutError.
     """
-    headers = {
-        'Accept-Encoding': 'gzip',
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
+    if isinstance(params, bytes):
+        body = params
+    else:
+        if isinstance(params, dict):
+            params = params.items()
+        # Encode the way requests does: omit None values and repeat the
+        # key for each item of a list value.
+        body = urlencode([(k, v) for k, v in params if v is not None],
+                         doseq=True).encode('ascii')
+    if len(body) >= COMPRESS_THRESHOLD:
+        body = _compress(body)
+        headers = _COMPRESSED_FORM_HEADERS
+    else:
+        headers = _FORM_HEADERS
 
-    with requests.Session() as session:
-        session.mount('http://', CompressedHTTPAdapter())
-        try:
-            if isinstance(params.get('meta'), list):
-                params['meta'] = ' '.join(params['meta'])
-            response = session.post(url,
-                                    data=params,
-                                    headers=headers,
-                                    timeout=timeout)
-        except requests.exceptions.RequestException as exc:
-            raise WebServiceError("HTTP request failed: {0}".format(exc))
-        except requests.exceptions.ReadTimeout:
-            raise WebServiceError(
-                "HTTP request timed out ({0}s)".format(timeout)
-            )
+    try:
+        response = _SESSION.post(url,
+                                 data=body,
+                                 headers=headers,
+                                 timeout=timeout)
+    except requests.exceptions.RequestException as exc:
+        raise WebServiceError("HTTP request failed: {0}".format(exc))
+    except requests.exceptions.ReadTimeout:
+        raise WebServiceError(
+            "HTTP request timed out ({0}s)".format(timeout)
+        )
 
     try:
-        return response.json()
+        return _json_loads(response.content)
     except ValueError:
         raise WebServiceError('response is not valid JSON')
 
 
+# Persistent cache of lookup responses.
+
+class LookupCache(object):
+    """A cache of Web service lookup responses, stored in an SQLite
+    database so that it persists between runs. Entries older than
+    ``ttl`` seconds are ignored and purged when the cache is opened.
+    The cache may be shared between threads.
+    """
+    def __init__(self, path, ttl=CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS lookups '
+                '(key TEXT PRIMARY KEY, time REAL, response BLOB)'
+            )
+            self.conn.execute('DELETE FROM lookups WHERE time < ?',
+                              (time.time() - ttl,))
+
+    def get(self, key):
+        """Get the parsed response stored under ``key``, or None if
+        there is no fresh entry.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT time, response FROM lookups WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None or row[0] < time.time() - self.ttl:
+            return None
+        return _json_loads(row[1])
+
+    def set(self, key, response):
+        """Store a parsed response under ``key``."""
+        data = json.dumps(response).encode('utf8')
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO lookups VALUES (?, ?, ?)',
+                (key, time.time(), data)
+            )
+
+    def close(self):
+        """Close the underlying database."""
+        with self.lock:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_cache(path, ttl=CACHE_TTL):
+    """Open (or create) a persistent lookup cache at the given file
+    path. Pass the result as the ``cache`` argument of ``lookup``,
+    ``match``, or ``match_many`` to avoid repeating identical queries.
+    """
+    return LookupCache(path, ttl)
+
+
+def _lookup_cache_key(fingerprint, duration, meta):
+    """Get the cache key for a lookup query."""
+    if not isinstance(fingerprint, bytes):
+        fingerprint = fingerprint.encode('ascii')
+    key = hashlib.blake2b(digest_size=16)
+    key.update(fingerprint)
+    key.update(b' %i ' % int(duration))
+    if meta is not None:
+        key.update(meta.encode('utf8'))
+    return key.hexdigest()
+
+
 # Main API.
 
+@functools.lru_cache(maxsize=16)
+def _lookup_body_prefix(apikey, meta):
+    """Get the encoded part of a lookup request body that stays the same
+    across queries with the same API key and ``meta`` string.
+    """
+    return 'format=json&client=%s&meta=%s' % (quote_plus(apikey),
+                                              quote_plus(meta))
+
+
+def _byte_view(block):
+    """Get a flat, byte-oriented view of a buffer such as a memoryview
+    or a NumPy array, so that its length is its size in bytes.
+    """
+    view = memoryview(block)
+    if view.c_contiguous:
+        return view.cast('B')
+    return view.tobytes()
+
+
 def fingerprint(samplerate, channels, pcmiter, maxlength=MAX_AUDIO_LENGTH):
     """Fingerprint audio data given its sample rate and number of
     channels.  pcmiter should be an iterable containing blocks of PCM
-    data as byte strings. Raises a FingerprintGenerationError if
-    anything goes wrong.
+    data as byte strings or other buffers (e.g., NumPy arrays of 16-bit
+    samples). Raises a FingerprintGenerationError if anything goes
+    wrong.
     """
-    # Maximum number of samples to decode.
-    endposition = samplerate * channels * maxlength
+    # Maximum number of bytes to decode (2 bytes/sample).
+    endposition = samplerate * channels * maxlength * 2
 
     try:
-        fper = chromaprint.Fingerprinter()
+        fper = _get_fingerprinter()
         fper.start(samplerate, channels)
 
-        position = 0  # Samples of audio fed to the fingerprinter.
+        # Collect small blocks into a larger buffer so that we cross
+        # into the library once per chunk rather than once per block.
+        buf = bytearray(READ_BUFFER_SIZE)
+        view = memoryview(buf)
+        filled = 0  # Bytes waiting in the buffer.
+
+        position = 0  # Bytes of audio fed to the fingerprinter.
         for block in pcmiter:
-            fper.feed(block)
-            position += len(block) // 2  # 2 bytes/sample.
+            if not isinstance(block, bytes):
+                block = _byte_view(block)
+            size = len(block)
+            position += size
+
+            if filled + size > READ_BUFFER_SIZE:
+                if filled:
+                    fper.feed(view[:filled])
+                    filled = 0
+                if size >= READ_BUFFER_SIZE:
+                    # Big enough to go straight to the library.
+                    fper.feed(block)
+                    size = 0
+            if size:
+                buf[filled:filled + size] = block
+                filled += size
+
             if position >= endposition:
                 break
 
+        if filled:
+            fper.feed(view[:filled])
         return fper.finish()
     except chromaprint.FingerprintError:
         raise FingerprintGenerationError("fingerprint calculation failed")
 
 
-def lookup(apikey, fingerprint, duration, meta=DEFAULT_META, timeout=None):
+def lookup(apikey, fingerprint, duration, meta=DEFAULT_META, timeout=None,
+           cache=None):
     """Look up a fingerprint with the Acoustid Web service. Returns the
     Python object reflecting the response JSON data. To get more data
     back, ``meta`` can be a list of keywords from this list: recordings,
     recordingids, releases, releaseids, releasegroups, releasegroupids,
-    tracks, compress, usermeta, sources.
+    tracks, compress, usermeta, sources. If a ``cache`` from
+    ``open_cache`` is given, successful responses are stored there and
+    reused for identical queries.
     """
-    params = {
-        'format': 'json',
-        'client': apikey,
-        'duration': int(duration),
-        'fingerprint': fingerprint,
-        'meta': meta,
-    }
-    return _api_request(_get_lookup_url(), params, timeout)
+    if isinstance(meta, list):
+        meta = ' '.join(meta)
+
+    if cache is not None:
+        key = _lookup_cache_key(fingerprint, duration, meta)
+        response = cache.get(key)
+        if response is not None:
+            return response
+
+    if apikey is None or meta is None:
+        # Let the generic encoder omit the missing fields.
+        body = [
+            ('format', 'json'),
+            ('client', apikey),
+            ('duration', int(duration)),
+            ('fingerprint', fingerprint),
+            ('meta', meta),
+        ]
+    else:
+        # The parameters are always the same, so only the per-query
+        # values need encoding; the rest is reused between calls.
+        body = _lookup_body_prefix(apikey, meta)
+        body += '&duration=%i&fingerprint=%s' % (int(duration),
+                                                 quote_plus(fingerprint))
+        body = body.encode('ascii')
+    response = _api_request(_LOOKUP_URL, body, timeout)
+
+    if cache is not None and response.get('status') == 'ok':
+        cache.set(key, response)
+    return response
+
+
+def _artist_name(artists):
+    """Join a recording's artist credits, including their join phrases,
+    into a single name. Returns None if no artists are given.
+    """
+    if not artists:
+        return None
+    return "".join(
+        [artist["name"] + artist.get("joinphrase", "") for artist in artists]
+    )
+
+
+def parse_lookup_result_list(data):
+    """Like ``parse_lookup_result``, but build and return a list of all
+    the tuples at once. The response is validated immediately.
+    """
+    if data['status'] != 'ok':
+        raise WebServiceError("status: %s" % data['status'])
+    if 'results' not in data:
+        raise WebServiceError("results not included")
+
+    # Results without recordings attached are not very useful, so they
+    # are skipped.
+    return [
+        (result['score'], recording['id'], recording.get('title'),
+         _artist_name(recording.get('artists')))
+        for result in data['results'] if 'recordings' in result
+        for recording in result['recordings']
+    ]
 
 
 def parse_lookup_result(data):
@@ -259,31 +467,7 @@ def parse_lookup_result(data):
     the last item is None. If the response is incomplete, raises a
     WebServiceError.
     """
-    if data['status'] != 'ok':
-        raise WebServiceError("status: %s" % data['status'])
-    if 'results' not in data:
-        raise WebServiceError("results not included")
-
-    for result in data['results']:
-        score = result['score']
-        if 'recordings' not in result:
-            # No recording attached. This result is not very useful.
-            continue
-
-        for recording in result['recordings']:
-            # Get the artist if available.
-            artists = recording.get("artists")
-            if artists:
-                artist_name = "".join(
-                    [
-                        artist["name"] + artist.get("joinphrase", "")
-                        for artist in artists
-                    ]
-                )
-            else:
-                artist_name = None
-
-            yield score, recording['id'], recording.get('title'), artist_name
+    yield from parse_lookup_result_list(data)
 
 
 def _fingerprint_file_audioread(path, maxlength):
@@ -302,10 +486,8 @@ def _fingerprint_file_fpcalc(path, maxlength):
     fpcalc = os.environ.get(FPCALC_ENVVAR, FPCALC_COMMAND)
     command = [fpcalc, "-length", str(maxlength), path]
     try:
-        with open(os.devnull, 'wb') as devnull:
-            proc = subprocess.Popen(command, stdout=subprocess.PIPE,
-                                    stderr=devnull)
-            output, _ = proc.communicate()
+        proc = subprocess.run(command, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL)
     except OSError as exc:
         if exc.errno == errno.ENOENT:
             raise NoBackendError("fpcalc not found")
@@ -317,27 +499,23 @@ def _fingerprint_file_fpcalc(path, maxlength):
         # filenames can fail to encode on that platform. See:
         # http://bugs.python.org/issue1759845
         raise FingerprintGenerationError("argument encoding failed")
-    retcode = proc.poll()
-    if retcode:
+    if proc.returncode:
         raise FingerprintGenerationError("fpcalc exited with status %i" %
-                                         retcode)
+                                         proc.returncode)
 
-    duration = fp = None
-    for line in output.splitlines():
-        try:
-            parts = line.split(b'=', 1)
-        except ValueError:
-            raise FingerprintGenerationError("malformed fpcalc output")
-        if parts[0] == b'DURATION':
-            try:
-                duration = float(parts[1])
-            except ValueError:
-                raise FingerprintGenerationError("fpcalc duration not numeric")
-        elif parts[0] == b'FINGERPRINT':
-            fp = parts[1]
+    output = proc.stdout
+
+    fields = dict(line.split(b'=', 1) for line in output.splitlines()
+                  if b'=' in line)
+    duration = fields.get(b'DURATION')
+    fp = fields.get(b'FINGERPRINT')
 
     if duration is None or fp is None:
         raise FingerprintGenerationError("missing fpcalc output")
+    try:
+        duration = float(duration)
+    except ValueError:
+        raise FingerprintGenerationError("fpcalc duration not numeric")
     return duration, fp
 
 
@@ -403,7 +581,7 @@ def compare_fingerprints(a, b) -> float:
 
 
 def match(apikey, path, meta=DEFAULT_META, parse=True, force_fpcalc=False,
-          timeout=None):
+          timeout=None, cache=None):
     """Look up the metadata for an audio file. If ``parse`` is true,
     then ``parse_lookup_result`` is used to return an iterator over
     small tuple of relevant information; otherwise, the full parsed JSON
@@ -412,16 +590,38 @@ def match(apikey, path, meta=DEFAULT_META, parse=True, force_fpcalc=False,
     true, only the latter will be used. To get more data back, ``meta``
     can be a list of keywords from this list: recordings, recordingids,
     releases, releaseids, releasegroups, releasegroupids, tracks,
-    compress, usermeta, sources.
+    compress, usermeta, sources. A ``cache`` from ``open_cache`` may be
+    given to reuse earlier lookup responses.
     """
     duration, fp = fingerprint_file(path, force_fpcalc=force_fpcalc)
-    response = lookup(apikey, fp, duration, meta, timeout)
+    response = lookup(apikey, fp, duration, meta, timeout, cache)
     if parse:
         return parse_lookup_result(response)
     else:
         return response
 
 
+def match_many(apikey, paths, meta=DEFAULT_META, parse=True,
+               force_fpcalc=False, timeout=None, workers=None, cache=None):
+    """Look up the metadata for several audio files, like ``match``,
+    but concurrently. Files are handled on a pool of ``workers``
+    threads (the ``concurrent.futures`` default if unspecified), so
+    fingerprinting one file overlaps with the Web service lookups for
+    others while the lookups themselves remain rate-limited. The total
+    time approaches the larger of the fingerprinting time divided by
+    the number of workers and the lookup time alone. Generates
+    ``(path, result)`` pairs in the order of ``paths``; if a file
+    fails, its exception is raised when its pair is reached.
+    """
+    def match_one(path):
+        return path, match(apikey, path, meta, parse, force_fpcalc, timeout,
+                           cache)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for item in executor.map(match_one, paths):
+            yield item
+
+
 def submit(apikey, userkey, data, timeout=None):
     """Submit a fingerprint to the acoustid server. The ``apikey`` and
     ``userkey`` parameters are API keys for the application and the
@@ -442,11 +642,11 @@ def submit(apikey, userkey, data, timeout=None):
     if isinstance(data, dict):
         data = [data]
 
-    args = {
-        'format': 'json',
-        'client': apikey,
-        'user': userkey,
-    }
+    args = [
+        ('format', 'json'),
+        ('client', apikey),
+        ('user', userkey),
+    ]
 
     # Build up "field.#" parameters corresponding to the parameters
     # given in each dictionary.
@@ -457,10 +657,10 @@ def submit(apikey, userkey, data, timeout=None):
         # The duration needs to be an integer.
         d["duration"] = int(d["duration"])
 
-        for k, v in d.items():
-            args["%s.%s" % (k, i)] = v
+        suffix = '.%i' % i
+        args.extend((k + suffix, v) for k, v in d.items())
 
-    response = _api_request(_get_submit_url(), args, timeout)
+    response = _api_request(_SUBMIT_URL, args, timeout)
     if response.get('status') != 'ok':
         try:
             code = response['error']['code']
@@ -481,4 +681,4 @@ def get_submission_status(apikey, submission_id, timeout=None):
         'client': apikey,
         'id': submission_id,
     }
-    return _api_request(_get_submission_status_url(), params, timeout)
+    return _api_request(_SUBMISSION_STATUS_URL, params, timeout)
@@ -51,15 +51,19 @@ def aidmatch(filename):
         print("web service request failed:", exc.message, file=sys.stderr)
         sys.exit(1)
 
+    # Print each match with a single write, separated by blank lines.
     first = True
     for score, rid, title, artist in results:
+        lines = [
+            '%s - %s' % (artist, title),
+            'http://musicbrainz.org/recording/%s' % rid,
+            'Score: %i%%' % (int(score * 100)),
+        ]
         if first:
             first = False
         else:
-            print()
-        print_('%s - %s' % (artist, title))
-        print_('http://musicbrainz.org/recording/%s' % rid)
-        print_('Score: %i%%' % (int(score * 100)))
+            lines.insert(0, '')
+        print_('\n'.join(lines))
 
 
 if __name__ == '__main__':
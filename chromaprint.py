@@ -141,10 +141,17 @@ class Fingerprinter(object):
 
     def feed(self, data):
         """Send raw PCM audio data to the fingerprinter. Data may be
-        either a bytestring or a buffer object.
+        either a bytestring or a buffer object. Writable, contiguous
+        buffers (e.g., a bytearray) are passed to the library without
+        being copied.
         """
         if isinstance(data, BUFFER_TYPES):
-            data = BYTES_TYPE(data)
+            try:
+                view = memoryview(data)
+                data = (ctypes.c_char * view.nbytes).from_buffer(view)
+            except (TypeError, ValueError):
+                # Read-only or non-contiguous buffers must be copied.
+                data = BYTES_TYPE(data)
         elif not isinstance(data, bytes):
             raise TypeError('data must be bytes, buffer, or memoryview')
         _check(_libchromaprint.chromaprint_feed(
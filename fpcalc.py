@@ -22,12 +22,22 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import argparse
+import concurrent.futures
+import os
 import sys
 
 import acoustid
 import chromaprint
 
 
+def _fingerprint(path, length):
+    """Fingerprint a file, returning None if that fails."""
+    try:
+        return acoustid.fingerprint_file(path, length)
+    except Exception:
+        return None
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-length', metavar='SECS', type=int, default=120,
@@ -42,23 +52,26 @@ def main():
     # make gst not try to parse the args
     del sys.argv[1:]
 
-    first = True
-    for i, path in enumerate(args.paths):
-        try:
-            duration, fp = acoustid.fingerprint_file(path, args.length)
-        except Exception:
-            print("ERROR: unable to calculate fingerprint "
-                  "for file %s, skipping" % path, file=sys.stderr)
-            continue
-        if args.raw:
-            raw_fp = chromaprint.decode_fingerprint(fp)[0]
-            fp = ','.join(map(str, raw_fp))
-        if not first:
-            print
-        first = False
-        print('FILE=%s' % path)
-        print('DURATION=%d' % duration)
-        print('FINGERPRINT=%s' % fp.decode('utf8'))
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    # Fingerprint files concurrently, but print the results in order.
+    with concurrent.futures.ThreadPoolExecutor(os.cpu_count()) as executor:
+        results = executor.map(lambda path: _fingerprint(path, args.length),
+                               args.paths)
+
+        for path, result in zip(args.paths, results):
+            if result is None:
+                print("ERROR: unable to calculate fingerprint "
+                      "for file %s, skipping" % path, file=sys.stderr)
+                continue
+            duration, fp = result
+            if args.raw:
+                raw_fp = chromaprint.decode_fingerprint(fp)[0]
+                fp = ','.join(map(str, raw_fp)).encode('ascii')
+            # The fingerprint is ASCII, so write it out as bytes rather
+            # than decoding it first.
+            stdout.write(b'FILE=%s\nDURATION=%d\nFINGERPRINT=%s\n' %
+                         (os.fsencode(path), duration, fp))
 
 
 if __name__ == '__main__':